@@ -1,14 +1,43 @@
-import smbus2 as smbus
+import ctypes
+import fcntl
+import logging
+import os
+import threading
 import time
+import numpy as np
 from retry import retry
 
 from influxdb import InfluxDBClient
-client = InfluxDBClient('192.168.1.180',8086,'root','','sensor')
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+database = 'sensor'
+use_udp = False         # fire-and-forget writes to the InfluxDB UDP listener
+udp_port = 8089
+udp_batch_size = 15     # lines per datagram, keeps packets within a 1500 byte MTU
+
+client = InfluxDBClient('192.168.1.180',8086,'root','',database,use_udp=use_udp,udp_port=udp_port)
+# only the writer thread talks HTTP: one pooled keep-alive connection, with
+# quick reconnects instead of a fresh handshake per failed flush
+client._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=Retry(total=3, backoff_factor=0.1)))
 
 x_offset = 0.0
 y_offset = 0.0
 z_offset = 0.0
 
+sample_interval = 0.08  # seconds between samples
+batch_size = 500        # points per HTTP write
+flush_interval = 1.0    # seconds, upper bound on buffering delay
+buffer_length = 100000  # samples kept while InfluxDB is unreachable
+sampler_cpu = 3         # core the sampling loop is pinned to, None to disable
+drdy_pin = None         # BCM GPIO wired to INT1 to pace sampling on DATA_RDY, None to use sample_interval
+drdy_timeout = 1.0      # seconds to wait for DATA_RDY before reading anyway
+i2c_baudrate = 400000   # expected SCL rate, see dtparam=i2c_arm_baudrate in /boot/config.txt
+
+# InfluxDB line protocol, one line per sample
+LINE_FORMAT = 'adxl355_measure x-axis=%f,y-axis=%f,z-axis=%f %d'
+
 g = 9.80665 # m/s/s
 
 POWER_CTL           = 0x2D
@@ -25,26 +54,33 @@ RANGE_MASK          = 0x03
 RANGE_2G            = 0b01
 RANGE_4G            = 0b10
 RANGE_8G            = 0b11
+RANGE_INT_POL_HIGH  = 0x40
+
+INT_MAP             = 0x2A
+INT_MAP_RDY_EN1     = 0x01
 
 # Convenience class
 class ADXL355Range:
     range2G = RANGE_2G
     range4G = RANGE_4G
     range8G = RANGE_8G
+    # LSB/g indexed by range code; code 0 is not a valid range
+    rangeLsbPerG = (None, 256000.0, 128000.0, 64000.0)
 
 LOWPASS_FILTER      = 0x28
 LOWPASS_FILTER_MASK = 0x0F
-LOWPASS_FILTER_4000 = 0x0000
-LOWPASS_FILTER_2000 = 0x0001
-LOWPASS_FILTER_1000 = 0x0010
-LOWPASS_FILTER_500  = 0x0011
-LOWPASS_FILTER_250  = 0x0100
-LOWPASS_FILTER_125  = 0x0101
-LOWPASS_FILTER_62_5 = 0x0110
-LOWPASS_FILTER_31_25    = 0x0111
-LOWPASS_FILTER_15_625   = 0x1000
-LOWPASS_FILTER_7_813    = 0x1001
-LOWPASS_FILTER_3_906    = 0x1010
+# ODR_LPF codes, named by output data rate; the lowpass corner is ODR / 4
+LOWPASS_FILTER_4000 = 0b0000
+LOWPASS_FILTER_2000 = 0b0001
+LOWPASS_FILTER_1000 = 0b0010
+LOWPASS_FILTER_500  = 0b0011
+LOWPASS_FILTER_250  = 0b0100
+LOWPASS_FILTER_125  = 0b0101
+LOWPASS_FILTER_62_5 = 0b0110
+LOWPASS_FILTER_31_25    = 0b0111
+LOWPASS_FILTER_15_625   = 0b1000
+LOWPASS_FILTER_7_813    = 0b1001
+LOWPASS_FILTER_3_906    = 0b1010
 
 class ADXL355LowpassFilter:
     lowpassFilter_4000 = LOWPASS_FILTER_4000
@@ -95,7 +131,101 @@ STATUS              = 0x04
 STATUS_MASK_DATARDY = 0x01
 STATUS_MASK_NVMBUSY = 0x10
 
-bus = smbus.SMBus(1)
+# STATUS, FIFO_ENTRIES, TEMP2/1 and XDATA3..ZDATA1 are contiguous
+ALL_START           = STATUS
+ALL_LENGTH          = 13
+ALL_TEMP_OFFSET     = TEMP_START - ALL_START
+ALL_AXIS_OFFSET     = AXIS_START - ALL_START
+
+# linux/i2c-dev.h, linux/i2c.h
+I2C_RDWR            = 0x0707
+I2C_M_RD            = 0x0001
+
+class I2CMsg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+class I2CRdwrIoctlData(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(I2CMsg)),
+                ('nmsgs', ctypes.c_uint32)]
+
+# Prebuilt register-write/read message pair for a fixed register block; the
+# same buffers are reused for every transfer and read back through data
+class I2CBlockRead:
+
+    def __init__(self, addr, reg, length):
+        self._regBuf = (ctypes.c_uint8 * 1)(reg)
+        self._readBuf = (ctypes.c_uint8 * length)()
+        self._msgs = (I2CMsg * 2)(I2CMsg(addr, 0, 1, self._regBuf), I2CMsg(addr, I2C_M_RD, length, self._readBuf))
+        self._ioctlData = I2CRdwrIoctlData(self._msgs, 2)
+        self.data = memoryview(self._readBuf).cast('B')
+
+# Minimal /dev/i2c-N access through I2C_RDWR, with the smbus2 byte accessors
+# ADXL355 needs and a combined register-write/read for block transfers
+class FastI2C:
+
+    def __init__(self, busNumber = 1):
+        self._fd = os.open('/dev/i2c-%d' % busNumber, os.O_RDWR)
+
+    def close(self):
+        os.close(self._fd)
+
+    def _transfer(self, *msgs):
+        msgArray = (I2CMsg * len(msgs))(*msgs)
+        fcntl.ioctl(self._fd, I2C_RDWR, I2CRdwrIoctlData(msgArray, len(msgs)))
+
+    def transfer(self, blockRead):
+        fcntl.ioctl(self._fd, I2C_RDWR, blockRead._ioctlData)
+        return blockRead.data
+
+    def readBlock(self, addr, reg, length):
+        regBuf = (ctypes.c_uint8 * 1)(reg)
+        readBuf = (ctypes.c_uint8 * length)()
+        self._transfer(I2CMsg(addr, 0, 1, regBuf), I2CMsg(addr, I2C_M_RD, length, readBuf))
+        return bytes(readBuf)
+
+    def read_byte_data(self, addr, reg):
+        return self.readBlock(addr, reg, 1)[0]
+
+    def write_byte_data(self, addr, reg, value):
+        writeBuf = (ctypes.c_uint8 * 2)(reg, value)
+        self._transfer(I2CMsg(addr, 0, 2, writeBuf))
+
+bus = FastI2C(1)
+
+# The SCL rate is fixed at boot by the device tree; warn if it is slower than
+# i2c_baudrate, since bus time bounds the sample rate
+def checkI2CBaudrate(busNumber = 1):
+    try:
+        with open('/sys/class/i2c-adapter/i2c-%d/of_node/clock-frequency' % busNumber, 'rb') as f:
+            baudrate = int.from_bytes(f.read(4), 'big')
+    except OSError:
+        return
+    if baudrate < i2c_baudrate:
+        logging.warning('i2c-%d runs at %d Hz, add dtparam=i2c_arm_baudrate=%d to /boot/config.txt',
+                        busNumber, baudrate, i2c_baudrate)
+
+def decodeTemperature(tempBytes):
+    temp = tempBytes[0] << 8 | tempBytes[1]
+    return (1852 - temp) / 9.05 + 19.21
+
+def decodeAxes(axisBytes):
+    # 20-bit two's complement, sign-extended without branching
+    axisX = (((axisBytes[0] << 16 | axisBytes[1] << 8 | axisBytes[2]) >> 4) ^ 0x80000) - 0x80000
+    axisY = (((axisBytes[3] << 16 | axisBytes[4] << 8 | axisBytes[5]) >> 4) ^ 0x80000) - 0x80000
+    axisZ = (((axisBytes[6] << 16 | axisBytes[7] << 8 | axisBytes[8]) >> 4) ^ 0x80000) - 0x80000
+
+    return (axisX, axisY, axisZ)
+
+def decodeAxesBatch(axisBytes):
+    # (n, 9) uint8 register dumps -> (n, 3) int32 x/y/z counts. Each 3-byte
+    # sample is copied into the top of a big-endian int32, so the arithmetic
+    # shift both drops the 4 unused bits and sign-extends the 20-bit value.
+    words = np.zeros((axisBytes.shape[0], 3, 4), dtype=np.uint8)
+    words[:, :, :3] = axisBytes.reshape(-1, 3, 3)
+    return words.view('>i4')[:, :, 0] >> 12
 
 class ADXL355:
 
@@ -103,6 +233,15 @@ class ADXL355:
 
     def __init__(self, addr = 0x1d):
         self._devAddr = addr
+        # m/s/s per LSB for the power-on default range, and per-axis offsets
+        self._scale = g / ADXL355Range.rangeLsbPerG[RANGE_2G]
+        self._ox = 0.0
+        self._oy = 0.0
+        self._oz = 0.0
+        self._offsets32 = np.zeros(3, dtype=np.float32)
+        self._tempRead = I2CBlockRead(addr, TEMP_START, TEMP_LENGTH)
+        self._axisRead = I2CBlockRead(addr, AXIS_START, AXIS_LENGTH)
+        self._allRead = I2CBlockRead(addr, ALL_START, ALL_LENGTH)
 
     def begin(self):
         powerCtl = bus.read_byte_data(self._devAddr, POWER_CTL)
@@ -123,13 +262,21 @@ class ADXL355:
         if type(newLowpassFilter) is not int:
             raise ValueError('newLowpassFilter must be an integer')
 
-        if newLowpassFilter < LOWPASS_FILTER_3_906 or newLowpassFilter > LOWPASS_FILTER_4000:
+        if newLowpassFilter < LOWPASS_FILTER_4000 or newLowpassFilter > LOWPASS_FILTER_3_906:
             raise ValueError('newLowpassFilter is out of range')
 
         lowpassFilter = bus.read_byte_data(self._devAddr, LOWPASS_FILTER)
-        lowpassFilter = (lowpassFilter & LOWPASS_FILTER_MASK) | newLowpassFilter
+        lowpassFilter = (lowpassFilter & ~LOWPASS_FILTER_MASK) | newLowpassFilter
         bus.write_byte_data(self._devAddr, LOWPASS_FILTER, lowpassFilter)
 
+    lowpassFilter = property(getLowpassFilter, setLowpassFilter)
+
+    # Routes DATA_RDY to INT1, active high; call while in standby
+    def enableDataReadyInterrupt(self):
+        bus.write_byte_data(self._devAddr, INT_MAP, INT_MAP_RDY_EN1)
+        range = bus.read_byte_data(self._devAddr, RANGE)
+        bus.write_byte_data(self._devAddr, RANGE, range | RANGE_INT_POL_HIGH)
+
     def getRange(self):
         return (bus.read_byte_data(self._devAddr, RANGE)) & RANGE_MASK
 
@@ -143,9 +290,16 @@ class ADXL355:
         range = bus.read_byte_data(self._devAddr, RANGE)
         range = (range & ~RANGE_MASK) | newRange
         bus.write_byte_data(self._devAddr, RANGE, range)
+        self._scale = g / ADXL355Range.rangeLsbPerG[newRange]
 
     range = property(getRange, setRange)
 
+    def setOffsets(self, x, y, z):
+        self._ox = float(x)
+        self._oy = float(y)
+        self._oz = float(z)
+        self._offsets32 = np.array((x, y, z), dtype=np.float32)
+
     def isRunning(self):
         powerCtl = bus.read_byte_data(self._devAddr, POWER_CTL)
 
@@ -154,6 +308,8 @@ class ADXL355:
     isRunning = property(isRunning)
 
 
+    # A separate read-byte transfer, for diagnostics only: the sampling loops
+    # never poll it, sampleOnDataReady() trusts the INT1 edge instead
     def getStatus(self):
         status = bus.read_byte_data(self._devAddr, STATUS)
         return status & STATUS_MASK_DATARDY
@@ -161,61 +317,229 @@ class ADXL355:
     status = property(getStatus)
 
     def getTemperature(self):
-        tempBytes = bus.read_i2c_block_data(self._devAddr, TEMP_START, TEMP_LENGTH)
-        temp = tempBytes[0] << 8 | tempBytes[1]
-        temp = (1852 - temp) / 9.05 + 19.21
-        return temp
+        return decodeTemperature(bus.transfer(self._tempRead))
 
     temperature = property(getTemperature)
 
+    # Returns a view of the shared read buffer, valid until the next read
+    def getAxisBytes(self):
+        return bus.transfer(self._axisRead)
+
     def getAxes(self):
-        axisBytes = bus.read_i2c_block_data(0x1d, AXIS_START, AXIS_LENGTH)
+        return decodeAxes(self.getAxisBytes())
 
-        axisX = (axisBytes[0] << 16 | axisBytes[1] << 8 | axisBytes[2]) >> 4
-        axisY = (axisBytes[3] << 16 | axisBytes[4] << 8 | axisBytes[5]) >> 4
-        axisZ = (axisBytes[6] << 16 | axisBytes[7] << 8 | axisBytes[8]) >> 4
+    def readAxesBatch(self, n):
+        axisBytes = np.empty((n, AXIS_LENGTH), dtype=np.uint8)
+        for i in range(n):
+            axisBytes[i] = self.getAxisBytes()
+        return decodeAxesBatch(axisBytes)
 
-        if(axisX & (1 << 20 - 1)):
-            axisX = axisX - (1 << 20)
+    axes = property(getAxes)
 
-        if(axisY & (1 << 20 - 1)):
-            axisY = axisY - (1 << 20)
+    # Returns a view of the shared read buffer, valid until the next read
+    def getAllBytes(self):
+        return bus.transfer(self._allRead)
 
-        if(axisZ & (1 << 20 - 1)):
-            axisZ = axisZ - (1 << 20)
+    # Status, temperature and axes from a single 13 byte transfer
+    def readAll(self):
+        allBytes = self.getAllBytes()
+        status = allBytes[0] & STATUS_MASK_DATARDY
+        temp = decodeTemperature(allBytes[ALL_TEMP_OFFSET:])
+        return (status, temp) + decodeAxes(allBytes[ALL_AXIS_OFFSET:])
 
-        return {'x': axisX, 'y': axisY, 'z': axisZ}
+    def getAcceleration(self):
+        axisX, axisY, axisZ = self.getAxes()
+        return (axisX * self._scale + self._ox, axisY * self._scale + self._oy, axisZ * self._scale + self._oz)
 
-    axes = property(getAxes)
+    acceleration = property(getAcceleration)
+
+    # float32 is exact for the 20-bit counts; the scaled values stay well
+    # below one LSB of rounding error
+    def convertAxesBatch(self, axisBytes):
+        axes = decodeAxesBatch(axisBytes).astype(np.float32)
+        axes *= np.float32(self._scale)
+        axes += self._offsets32
+        return axes
 
     def getAxisX(self):
-        return self.axes['x']
+        return self.axes[0]
 
     axisX = property(getAxisX)
 
     def getAxisY(self):
-        return self.axes['y']
+        return self.axes[1]
 
     axisY = property(getAxisY)
 
     def getAxisZ(self):
-        return self.axes['z']
+        return self.axes[2]
 
     axisZ = property(getAxisZ)
 
+adxl355 = ADXL355()
+
+# Preallocated ring buffer between the sampling loop and the writer thread.
+# Raw axis register bytes and timestamps live in separate contiguous arrays;
+# _head/_tail count samples appended/consumed, slot = count % length.
+class SampleRing:
+
+    def __init__(self, length):
+        self._length = length
+        self._axisBytes = np.empty((length, AXIS_LENGTH), dtype=np.uint8)
+        self._timestamps = np.empty(length, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def append(self, axisBytes, timestamp):
+        slot = self._head % self._length
+        with self._lock:
+            self._axisBytes[slot] = axisBytes
+            self._timestamps[slot] = timestamp
+            self._head += 1
+            # full: drop the oldest sample
+            if self._head - self._tail > self._length:
+                self._tail = self._head - self._length
+
+    # Copies out up to n of the oldest samples (stopping at the wrap point);
+    # returns the count to pass to consume() once they have been written
+    def peek(self, n):
+        with self._lock:
+            slot = self._tail % self._length
+            count = min(n, self._head - self._tail, self._length - slot)
+            return (self._tail + count,
+                    self._axisBytes[slot:slot + count].copy(),
+                    self._timestamps[slot:slot + count].copy())
+
+    def consume(self, end):
+        with self._lock:
+            self._tail = max(self._tail, end)
+
+samples = SampleRing(buffer_length)
+flushRequest = threading.Event()
+stopRequest = threading.Event()
+dataReady = threading.Event()
+
+# Formats a block into line-protocol payloads of up to linesPerPayload lines,
+# each with a single % over a repeated LINE_FORMAT template
+def formatPayloads(axisBytes, timestamps, linesPerPayload):
+    rows = np.empty((len(timestamps), 4), dtype=object)
+    rows[:, :3] = adxl355.convertAxesBatch(axisBytes)
+    rows[:, 3] = timestamps // 1000000     # ns -> ms
+    return ['\n'.join([LINE_FORMAT] * len(chunk)) % tuple(chunk.ravel().tolist())
+            for chunk in (rows[i:i + linesPerPayload] for i in range(0, len(rows), linesPerPayload))]
+
+writeFailing = False
+
+# Returns False if a retryable write failed and the samples were kept
+def flushPoints():
+    global writeFailing
+    while len(samples):
+        end, axisBytes, timestamps = samples.peek(batch_size)
+        try:
+            if use_udp:
+                for payload in formatPayloads(axisBytes, timestamps, udp_batch_size):
+                    client.send_packet([payload], protocol='line')
+            else:
+                client.write(formatPayloads(axisBytes, timestamps, batch_size)[0], params={'db': database, 'precision': 'ms'}, protocol='line')
+        except (OSError, InfluxDBServerError) as e:
+            # leave the samples in the ring for the next attempt, log once per outage
+            if not writeFailing:
+                logging.warning('InfluxDB write failed, retrying every %g s: %s', flush_interval, e)
+                writeFailing = True
+            return False
+        except InfluxDBClientError as e:
+            if e.code != 400:
+                # missing database, bad credentials: retrying cannot help
+                raise
+            # malformed batch: drop it rather than block the ring forever
+            logging.error('InfluxDB rejected %d points, dropping them: %s', len(timestamps), e)
+        if writeFailing:
+            logging.warning('InfluxDB writes recovered')
+            writeFailing = False
+        samples.consume(end)
+    return True
+
+def writer():
+    try:
+        while not stopRequest.is_set():
+            flushRequest.wait(flush_interval)
+            flushRequest.clear()
+            if not flushPoints():
+                # back off a full interval; the sampler keeps setting flushRequest
+                stopRequest.wait(flush_interval)
+        flushPoints()
+    except Exception:
+        # never keep sampling into a ring nobody drains; stop the whole process
+        logging.exception('InfluxDB writer stopped')
+        stopRequest.set()
+
+def sampleOnInterval():
+    nextSample = time.monotonic()
+    while not stopRequest.is_set():
+        samples.append(adxl355.getAxisBytes(), time.time_ns())
+        #print ("All axes X: %d Y: %d Z: %d" % adxl355.axes)
+        if len(samples) >= batch_size:
+            flushRequest.set()
+        # sleep to a fixed grid so read/flush time does not add up as drift
+        nextSample += sample_interval
+        delay = nextSample - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # overran the slot, resync instead of bursting to catch up
+            nextSample = time.monotonic()
+
+# One sample per DATA_RDY rising edge on INT1, at the chip's output data rate
+# (the value in the lowpassFilter_* name; the lowpass corner is ODR / 4). The
+# read starts at STATUS so that the same transfer acknowledges DATA_RDY and
+# lets INT1 fall for the next edge.
+def sampleOnDataReady():
+    while not stopRequest.is_set():
+        dataReady.wait(drdy_timeout)
+        dataReady.clear()
+        samples.append(adxl355.getAllBytes()[ALL_AXIS_OFFSET:], time.time_ns())
+        if len(samples) >= batch_size:
+            flushRequest.set()
+
 @retry(exceptions=OSError, delay=5)
 def run():
-    adxl355 = ADXL355()
+    # the configuration registers are only written in standby; after a retry
+    # the chip is still measuring from the previous begin()
+    adxl355.end()
     adxl355.range = ADXL355Range.range4G
+    adxl355.setOffsets(x_offset, y_offset, z_offset)
     adxl355.lowpassFilter = ADXL355LowpassFilter.lowpassFilter_62_5
+    if drdy_pin is not None:
+        adxl355.enableDataReadyInterrupt()
     adxl355.begin()
-    while True:
-        allAxes = adxl355.axes
-        wp_body = [{"measurement": "adxl355_measure","fields":{"x-axis":allAxes['x']*g/256000.0+x_offset,"y-axis":allAxes['y']*g/256000.0+y_offset,"z-axis":allAxes['z']*g/256000.0+z_offset}}]
-        client.write_points(wp_body)
-        #print ("All axes X: %f Y: %f Z: %f" % (allAxes['x']*g/256000.0, allAxes['y']*g/256000.0, allAxes['z']*g/256000.0))
-        time.sleep(0.08)
+    if drdy_pin is not None:
+        sampleOnDataReady()
+    else:
+        sampleOnInterval()
 
 if __name__ == "__main__":
-    run()
-
+    checkI2CBaudrate(1)
+    # set up DRDY before the writer starts, so a missing gpiozero or busy pin
+    # cannot leave the writer thread running on its own
+    if drdy_pin is not None:
+        from gpiozero import DigitalInputDevice
+        drdy = DigitalInputDevice(drdy_pin, pull_up=False)
+        drdy.when_activated = dataReady.set
+    writerThread = threading.Thread(target=writer)
+    writerThread.start()
+    try:
+        # pin only the sampling (main) thread; the writer keeps the other cores
+        if sampler_cpu is not None and hasattr(os, 'sched_setaffinity') and sampler_cpu in os.sched_getaffinity(0):
+            os.sched_setaffinity(0, {sampler_cpu})
+        run()
+    finally:
+        writerFailed = stopRequest.is_set()
+        stopRequest.set()
+        flushRequest.set()
+        writerThread.join()
+    if writerFailed:
+        raise SystemExit(1)